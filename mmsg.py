@@ -0,0 +1,157 @@
+""" ctypes bindings for Linux recvmmsg(2)/sendmmsg(2).
+
+    Lets the proxy drain a batch of UDP datagrams with one syscall and
+    forward them with one syscall per destination, instead of paying a
+    kernel entry per packet.
+"""
+import ctypes
+import socket
+
+
+BATCH = 64
+
+MSG_DONTWAIT = 0x40
+
+EAGAIN = 11
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [
+        ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int,
+        ctypes.c_void_p,
+    ]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [
+        ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int,
+    ]
+    _sendmmsg.restype = ctypes.c_int
+    AVAILABLE = True
+except (OSError, AttributeError):
+    AVAILABLE = False
+
+
+class Forwarder(object):
+    """ Preallocated recvmmsg/sendmmsg machinery for one direction.
+
+        One instance holds the receive buffers and the scatter/gather
+        headers for forwarding them on - nothing is allocated per packet.
+        Output sockets must be connected to their destination, so sends
+        carry no address and the kernel reuses its cached route.
+    """
+    def __init__(self, packet_max, batch=BATCH):
+        self._batch = batch
+        self._bufs = [
+            ctypes.create_string_buffer(packet_max) for _ in range(batch)
+        ]
+
+        # Receive side - one iovec per slot, source address ignored.
+        self._recv_iovs = (iovec * batch)()
+        self._recv_hdrs = (mmsghdr * batch)()
+        for i in range(batch):
+            self._recv_iovs[i].iov_base = ctypes.cast(
+                self._bufs[i], ctypes.c_void_p
+            )
+            self._recv_iovs[i].iov_len = packet_max
+            hdr = self._recv_hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._recv_iovs[i])
+            hdr.msg_iovlen = 1
+
+        # Forward side - same buffers, no address (connected sockets).
+        self._send_hdrs = (mmsghdr * batch)()
+        for i in range(batch):
+            hdr = self._send_hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._recv_iovs[i])
+            hdr.msg_iovlen = 1
+
+        # Repeater side - two iovecs per slot so the direction marker
+        # never has to be concatenated onto the payload.
+        self._prefix = ctypes.create_string_buffer(1)
+        self._rep_iovs = (iovec * (batch * 2))()
+        self._rep_hdrs = (mmsghdr * batch)()
+        for i in range(batch):
+            self._rep_iovs[i * 2].iov_base = ctypes.cast(
+                self._prefix, ctypes.c_void_p
+            )
+            self._rep_iovs[i * 2].iov_len = 1
+            self._rep_iovs[i * 2 + 1].iov_base = ctypes.cast(
+                self._bufs[i], ctypes.c_void_p
+            )
+            hdr = self._rep_hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._rep_iovs[i * 2])
+            hdr.msg_iovlen = 2
+
+    def pump(self, in_fd, out_fd, repeat_fds, prefix):
+        """ Drain up to a batch of datagrams from in_fd and forward them.
+
+            'out_fd' and each of 'repeat_fds' are connected sockets;
+            repeated copies get 'prefix' prepended in the kernel via the
+            second iovec. Returns the number of packets moved.
+        """
+        count = _recvmmsg(
+            in_fd, self._recv_hdrs, self._batch, MSG_DONTWAIT, None
+        )
+        if count <= 0:
+            errno = ctypes.get_errno()
+            if count < 0 and errno != EAGAIN:
+                raise socket.error(errno, 'recvmmsg failed')
+            return 0
+
+        for i in range(count):
+            length = self._recv_hdrs[i].msg_len
+            self._recv_iovs[i].iov_len = length
+            self._rep_iovs[i * 2 + 1].iov_len = length
+        self._sendall(out_fd, self._send_hdrs, count)
+
+        if repeat_fds:
+            self._prefix.raw = prefix
+            for fd in repeat_fds:
+                self._sendall(fd, self._rep_hdrs, count)
+
+        # Reset receive iovecs for the next batch.
+        packet_max = len(self._bufs[0])
+        for i in range(count):
+            self._recv_iovs[i].iov_len = packet_max
+        return count
+
+    def _sendall(self, fd, hdrs, count):
+        """ sendmmsg until the whole batch has gone out.
+        """
+        sent = 0
+        while sent < count:
+            remaining = ctypes.cast(
+                ctypes.byref(hdrs, sent * ctypes.sizeof(mmsghdr)),
+                ctypes.POINTER(mmsghdr)
+            )
+            result = _sendmmsg(fd, remaining, count - sent, 0)
+            if result < 0:
+                raise socket.error(ctypes.get_errno(), 'sendmmsg failed')
+            sent += result
@@ -1,298 +1,404 @@
-""" Proxy for Parrot devices.
-
-    Finds the first Jumping Sumo it can, re-advertises a proxied version on
-    all interfaces.
-"""
-import collections
-import json
-import netifaces
-import socket
-import time
-import threading
-import zeroconf
-import SocketServer
-
-
-def ip_addresses():
-    """ Return all my IP addresses.
-    """
-    addresses = []
-    for interface in netifaces.interfaces():
-        try:
-            for link in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
-                addresses.append(link['addr'])
-        except KeyError:
-            pass
-    return sorted(addresses)
-
-
-class SumoProxy(object):
-    """ Proxy for Jumping Sumo to display data.
-    """
-    RECV_MAX = 102400
-
-    def __init__(self, repeaters=None):
-        """ 'repeaters' argument is list of (ip, port) tuples.
-
-            Each is sent a copy of the data in each direction.
-        """
-        self._repeaters = [] if repeaters is None else repeaters
-        self._zc = zeroconf.Zeroconf()
-
-        # Monkey-patch the UDP socket server to recieve video packets.
-        SocketServer.UDPServer.max_packet_size = 65000
-
-    def get_first_sumo(self, service_type='_arsdk-0902._udp.local.'):
-        """ Return the IP and INIT port for the first Jumping Sumo you find.
-        """
-        connection_info = []
-
-        class Listener(object):
-            """ A simple listener for the sumo init service.
-            """
-            def remove_service(self, zc, type_, name):
-                """ We're not concerned with the remove_service event.
-                """
-                pass
-
-            def add_service(self, zc, type_, name):
-                """ If we've found the JumpingSumo service, get the info.
-                """
-                info = zc.get_service_info(type_, name)
-                connection_info.extend(
-                    (socket.inet_ntoa(info.address), info.port)
-                )
-
-        browser = zeroconf.ServiceBrowser(
-            self._zc, service_type, Listener()
-        )
-
-        wait_time = 30  # Seconds
-        started = time.time()
-        while len(connection_info) < 2:
-            if not browser.is_alive():
-                raise Exception('Zeroconf Browser crashed')
-            if time.time() - started > wait_time:
-                raise Exception(
-                    'No Sumo found within {} seconds'.format(wait_time)
-                )
-            time.sleep(0.1)
-        browser.cancel()
-
-        return connection_info[:2]
-
-    def announce_proxy_sumo(self, init_port,
-                            service_name='Sumo',
-                            service_type='_arsdk-0902._udp.local.'):
-        """ Announce the proxied Jumping Sumo on all interfaces.
-        """
-        for address in ip_addresses():
-            iface_service_name = '{}-{}'.format(
-                service_name,
-                address.replace('.', '-')
-            )
-            info = zeroconf.ServiceInfo(
-                service_type,
-                '.'.join((iface_service_name, service_type)),
-                socket.inet_aton(address),
-                init_port,
-                properties={},
-            )
-            self._zc.register_service(info)
-
-    def proxy_init(self, sumo_ip, init_port):
-        """ Proxy the init.
-        """
-        init_server = None
-        return_data = []
-
-        class InitHandler(SocketServer.BaseRequestHandler):
-            """ SocketServer handler for init handshake.
-            """
-            def handle(self):
-
-                # Capture the client's IP address.
-                client_ip = self.client_address[0]
-
-                # Get the init request, strip the trailing '\x00', convert to
-                # JSON
-                data = self.request.recv(SumoProxy.RECV_MAX)
-                json_data = json.loads(data[:-1])
-
-                # Grab the d2c port that the client is listening on - this is
-                # where it expects to recieve packets. Will probably be 54321.
-                client_d2c_port = json_data['d2c_port']
-
-                # Create a new d2c port that the proxy will listen on - this
-                # is how we intercept the packets. Will probably be 54322.
-                prox_d2c_port = client_d2c_port + 1
-
-                # Modify the init to tell the Sumo to send packets to the
-                # proxy's d2c port. We'll pass these on to the client's d2c
-                # port.
-                json_data['d2c_port'] = prox_d2c_port
-                data = json.dumps(json_data) + '\x00'
-
-                # Send on the init.
-                sumo_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sumo_sock.connect((sumo_ip, init_port))
-                sumo_sock.sendall(data)
-
-                # Get the init response, strip the trailing '\x00', convert to
-                # JSON
-                data = sumo_sock.recv(SumoProxy.RECV_MAX)
-                json_data = json.loads(data[:-1])
-                sumo_sock.close()
-
-                # Grab the c2d port that the sumo is listening on - we'll send
-                # packets to this later. Will probably be 54321.
-                sumo_c2d_port = json_data['c2d_port']
-
-                # Create a new c2d port for the proxy - this is where the
-                # client will send packets to and we'll pass them on to the
-                # Sumo's c2d port. Will probably be 54320.
-                prox_c2d_port = sumo_c2d_port - 1
-
-                # Modify the init response to tell the client to send packets
-                # to the proxy's c2d port, where the proxy can pass them on to
-                # the Sumo's c2d port.
-                json_data['c2d_port'] = prox_c2d_port
-                data = json.dumps(json_data) + '\x00'
-
-                # Return the modified init response back to the client.
-                self.request.sendall(data)
-
-                return_data.extend((
-                    client_ip, (
-                        sumo_c2d_port, client_d2c_port,
-                        prox_c2d_port, prox_d2c_port,
-                    )
-                ))
-
-                def tidy():
-                    """ Clean up the server.
-                    """
-                    init_server.shutdown()
-                    init_server.server_close()
-                threading.Thread(target=tidy).start()
-
-        init_server = SocketServer.TCPServer(('', init_port), InitHandler)
-        server_thread = threading.Thread(target=init_server.serve_forever)
-        server_thread.start()
-
-        wait_time = 30
-        server_thread.join(wait_time)
-
-        # If thread's still alive we didn't have an init
-        if server_thread.is_alive():
-            raise Exception(
-                'No init within {} seconds of announce'.format(wait_time)
-            )
-
-        return return_data
-
-    def proxy_session(self, client_ip, sumo_ip, sumo_c2d_port,
-                      client_d2c_port, prox_c2d_port, prox_d2c_port):
-        """ Proxy a UDP session between client and sumo.
-        """
-
-        data_queue = collections.deque([True], maxlen=1)
-        send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        repeaters = self._repeaters
-
-        class C2DHandler(SocketServer.BaseRequestHandler):
-            """ Handle client to sumo comms.
-            """
-            def handle(self):
-                data_queue.append(True)
-                data = self.request[0]
-                send_socket.sendto(data, (sumo_ip, sumo_c2d_port))
-
-                # Tee-off the data to another hosts
-                for target in repeaters:
-                    send_socket.sendto('>'+data, target)
-
-
-        class D2CHandler(SocketServer.BaseRequestHandler):
-            """ Handle sumo to client comms.
-            """
-            def handle(self):
-                data_queue.append(True)
-                data = self.request[0]
-                send_socket.sendto(data, (client_ip, client_d2c_port))
-
-                # Tee-off the data to another hosts
-                for target in repeaters:
-                    send_socket.sendto('<'+data, target)
-
-        c2d_server = SocketServer.UDPServer(('', prox_c2d_port), C2DHandler)
-        d2c_server = SocketServer.UDPServer(('', prox_d2c_port), D2CHandler)
-        t1 = threading.Thread(target=c2d_server.serve_forever)
-        t1.daemon = True
-        t1.start()
-        t2 = threading.Thread(target=d2c_server.serve_forever)
-        t2.daemon = True
-        t2.start()
-
-        comms_time = 1
-        while True:
-            try:
-                data_queue.pop()
-            except IndexError:
-                raise Exception(
-                    'No comms for more than {} seconds'.format(comms_time)
-                )
-            time.sleep(comms_time)
-
-    def start(self):
-        """ Handle all the things.
-        """
-        # Find the robot
-        print 'Searching for Jumping Sumo...',
-        sumo_ip, init_port = self.get_first_sumo()
-        print 'Done (found {})!'.format(sumo_ip)
-
-        # Announce equivalent sumo
-        print 'Announcing Sumo Proxy...',
-        self.announce_proxy_sumo(init_port)
-        print 'Done!'
-
-        print 'Waiting for client initiation...',
-        client_ip, ports = self.proxy_init(sumo_ip, init_port)
-        print 'Done!'
-
-        # If sumo_c2d_port (ports[0]) is zero, Sumo is currently in a session.
-        if ports[0] == 0:
-            raise Exception(
-                'Sumo responded that another client is already connected!'
-            )
-
-        print 'Serving session...',
-        self.proxy_session(client_ip, sumo_ip, *ports)
-        print 'Done!'
-
-
-def proc_wrapper(repeaters=None):
-    """ Run the proxy.
-    """
-    if repeaters is None:
-        repeaters = []
-    try:
-        proxy = SumoProxy(repeaters)
-        proxy.start()
-    except Exception as ex:
-        print 'Ex: {}'.format(ex)
-
-
-if __name__ == '__main__':
-
-    import multiprocessing
-    print 'Starting...'
-    while True:
-        proc = multiprocessing.Process(target=proc_wrapper)
-        proc.start()
-        proc.join()
-        proc.terminate()
-        print 'Restarting...'
-        time.sleep(1)
+""" Proxy for Parrot devices.
+
+    Finds the first Jumping Sumo it can, re-advertises a proxied version on
+    all interfaces.
+"""
+import netifaces
+import re
+import selectors
+import socket
+import time
+import threading
+import zeroconf
+
+import mmsg
+
+
+# Direction markers prepended to repeated packets.
+C2D_PREFIX = b'>'
+D2C_PREFIX = b'<'
+
+# The init handshake only ever needs two integer fields patched, so a
+# byte-level substitution beats parsing and re-serialising the JSON.
+D2C_PORT_RE = re.compile(rb'"d2c_port"\s*:\s*(\d+)')
+C2D_PORT_RE = re.compile(rb'"c2d_port"\s*:\s*(\d+)')
+
+
+# ip_addresses() cache - (expiry time, addresses).
+_ip_cache = [0, None]
+
+
+def ip_addresses(max_age=10):
+    """ Return all my IP addresses.
+
+        The interface enumeration is a pile of ioctls, so the result is
+        cached for 'max_age' seconds - plenty fresh for the restart loop.
+    """
+    if time.monotonic() < _ip_cache[0]:
+        return _ip_cache[1]
+
+    addresses = []
+    for interface in netifaces.interfaces():
+        for link in netifaces.ifaddresses(interface).get(netifaces.AF_INET,
+                                                         ()):
+            addresses.append(link['addr'])
+
+    _ip_cache[0] = time.monotonic() + max_age
+    _ip_cache[1] = sorted(addresses)
+    return _ip_cache[1]
+
+
+def enlarge_buffers(sock, size=12 * 1024 * 1024):
+    """ Grow a UDP socket's kernel buffers so video bursts aren't dropped.
+
+        Warns if the kernel caps the request - raising
+        net.core.rmem_max/wmem_max to the same size fixes that.
+    """
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+        # Linux reports double the granted value to cover bookkeeping.
+        granted = sock.getsockopt(socket.SOL_SOCKET, option) // 2
+        if granted < size:
+            print('Warning: kernel capped socket buffer at {} bytes'.format(
+                granted
+            ))
+
+
+def quicken_tcp(sock):
+    """ Stop Nagle/delayed-ack stretching the tiny handshake exchanges.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, 'TCP_QUICKACK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+def allow_port_sharing(sock):
+    """ Let the proxy ports be rebound immediately, and shared.
+
+        SO_REUSEPORT also leaves the door open to extra worker processes
+        on the same ports, should a session ever carry more than one
+        client/sumo flow.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+class SumoProxy(object):
+    """ Proxy for Jumping Sumo to display data.
+    """
+    RECV_MAX = 102400
+    PACKET_MAX = 65536  # Big enough for any video packet.
+
+    def __init__(self, repeaters=None):
+        """ 'repeaters' argument is list of (ip, port) tuples.
+
+            Each is sent a copy of the data in each direction.
+        """
+        self._repeaters = [] if repeaters is None else repeaters
+        self._zc = zeroconf.Zeroconf()
+
+    def close(self):
+        """ Withdraw our announcements and release zeroconf's sockets.
+        """
+        self._zc.unregister_all_services()
+        self._zc.close()
+
+    def get_first_sumo(self, service_type='_arsdk-0902._udp.local.'):
+        """ Return the IP and INIT port for the first Jumping Sumo you find.
+        """
+        connection_info = []
+        found = threading.Event()
+
+        class Listener(object):
+            """ A simple listener for the sumo init service.
+            """
+            def remove_service(self, zc, type_, name):
+                """ We're not concerned with the remove_service event.
+                """
+                pass
+
+            def add_service(self, zc, type_, name):
+                """ If we've found the JumpingSumo service, get the info.
+                """
+                # Skip unrelated records - and our own proxy announcements,
+                # which share the service type - before paying for a
+                # get_service_info round-trip.
+                if type_ != service_type:
+                    return
+                if not name.lower().startswith('jumpingsumo'):
+                    return
+                info = zc.get_service_info(type_, name)
+                connection_info.extend(
+                    (socket.inet_ntoa(info.address), info.port)
+                )
+                found.set()
+
+        browser = zeroconf.ServiceBrowser(
+            self._zc, service_type, Listener()
+        )
+
+        wait_time = 30  # Seconds
+        if not found.wait(wait_time):
+            if not browser.is_alive():
+                raise Exception('Zeroconf Browser crashed')
+            raise Exception(
+                'No Sumo found within {} seconds'.format(wait_time)
+            )
+        browser.cancel()
+
+        return connection_info[:2]
+
+    def announce_proxy_sumo(self, init_port,
+                            service_name='Sumo',
+                            service_type='_arsdk-0902._udp.local.'):
+        """ Announce the proxied Jumping Sumo on all interfaces.
+        """
+        for address in ip_addresses():
+            iface_service_name = '{}-{}'.format(
+                service_name,
+                address.replace('.', '-')
+            )
+            info = zeroconf.ServiceInfo(
+                service_type,
+                '.'.join((iface_service_name, service_type)),
+                socket.inet_aton(address),
+                init_port,
+                properties={},
+            )
+            self._zc.register_service(info)
+
+    def proxy_init(self, sumo_ip, init_port):
+        """ Proxy the init.
+
+            Only one client ever connects, so a single blocking accept
+            does the job without any server machinery or helper threads.
+        """
+        wait_time = 30
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.settimeout(wait_time)
+        listener.bind(('', init_port))
+        listener.listen(1)
+
+        try:
+            try:
+                conn, (client_ip, _) = listener.accept()
+            except socket.timeout:
+                raise Exception(
+                    'No init within {} seconds of announce'.format(wait_time)
+                )
+            quicken_tcp(conn)
+
+            # Get the init request.
+            data = conn.recv(self.RECV_MAX)
+
+            # Grab the d2c port that the client is listening on - this is
+            # where it expects to recieve packets. Will probably be 54321.
+            client_d2c_port = int(D2C_PORT_RE.search(data).group(1))
+
+            # Create a new d2c port that the proxy will listen on - this is
+            # how we intercept the packets. Will probably be 54322.
+            prox_d2c_port = client_d2c_port + 1
+
+            # Modify the init to tell the Sumo to send packets to the proxy's
+            # d2c port. We'll pass these on to the client's d2c port. Only
+            # the port number is rewritten; the rest of the message
+            # (including the trailing '\x00') passes unchanged.
+            data = D2C_PORT_RE.sub(
+                b'"d2c_port": %d' % prox_d2c_port, data, count=1
+            )
+
+            # Send on the init.
+            sumo_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            quicken_tcp(sumo_sock)
+            sumo_sock.connect((sumo_ip, init_port))
+            sumo_sock.sendall(data)
+
+            # Get the init response.
+            data = sumo_sock.recv(self.RECV_MAX)
+            sumo_sock.close()
+
+            # Grab the c2d port that the sumo is listening on - we'll send
+            # packets to this later. Will probably be 54321.
+            sumo_c2d_port = int(C2D_PORT_RE.search(data).group(1))
+
+            # Create a new c2d port for the proxy - this is where the client
+            # will send packets to and we'll pass them on to the Sumo's c2d
+            # port. Will probably be 54320.
+            prox_c2d_port = sumo_c2d_port - 1
+
+            # Modify the init response to tell the client to send packets to
+            # the proxy's c2d port, where the proxy can pass them on to the
+            # Sumo's c2d port.
+            data = C2D_PORT_RE.sub(
+                b'"c2d_port": %d' % prox_c2d_port, data, count=1
+            )
+
+            # Return the modified init response back to the client.
+            conn.sendall(data)
+            conn.close()
+        finally:
+            listener.close()
+
+        return client_ip, (
+            sumo_c2d_port, client_d2c_port,
+            prox_c2d_port, prox_d2c_port,
+        )
+
+    def proxy_session(self, client_ip, sumo_ip, sumo_c2d_port,
+                      client_d2c_port, prox_c2d_port, prox_d2c_port):
+        """ Proxy a UDP session between client and sumo.
+
+            A single-threaded select() loop over the two proxy sockets -
+            cheaper per packet than a handler thread, which matters for
+            the video stream.
+        """
+        # One connected socket per destination - the kernel caches the
+        # route once and send() skips the per-call address handling.
+        sumo_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        enlarge_buffers(sumo_sock)
+        sumo_sock.connect((sumo_ip, sumo_c2d_port))
+
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        enlarge_buffers(client_sock)
+        client_sock.connect((client_ip, client_d2c_port))
+
+        repeater_socks = []
+        for target in self._repeaters:
+            repeater_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            enlarge_buffers(repeater_sock)
+            repeater_sock.connect(target)
+            repeater_socks.append(repeater_sock)
+
+        # Client to sumo comms arrive here...
+        c2d_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        enlarge_buffers(c2d_socket)
+        allow_port_sharing(c2d_socket)
+        c2d_socket.bind(('', prox_c2d_port))
+
+        # ...and sumo to client comms arrive here.
+        d2c_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        enlarge_buffers(d2c_socket)
+        allow_port_sharing(d2c_socket)
+        d2c_socket.bind(('', prox_d2c_port))
+
+        session_socks = [sumo_sock, client_sock, c2d_socket, d2c_socket]
+        session_socks.extend(repeater_socks)
+
+        # Batch packets through recvmmsg/sendmmsg where libc has them,
+        # falling back to one recvfrom_into/send per packet.
+        forwarder = mmsg.Forwarder(self.PACKET_MAX) if mmsg.AVAILABLE else None
+        repeater_fds = [repeater.fileno() for repeater in repeater_socks]
+
+        # The fallback path reuses one receive buffer rather than letting
+        # recvfrom allocate up to 64 KB per packet.
+        recv_buf = bytearray(self.PACKET_MAX)
+        recv_view = memoryview(recv_buf)
+
+        selector = selectors.DefaultSelector()
+        selector.register(c2d_socket, selectors.EVENT_READ)
+        selector.register(d2c_socket, selectors.EVENT_READ)
+
+        comms_time = 1
+        last_rx = time.monotonic()
+        try:
+            while True:
+                # Sleep exactly until the liveness deadline - no fixed-period
+                # wakeups while traffic is flowing.
+                timeout = comms_time - (time.monotonic() - last_rx)
+                events = selector.select(max(0, timeout))
+                if not events:
+                    raise Exception(
+                        'No comms for more than {} seconds'.format(comms_time)
+                    )
+
+                # One clock read per wakeup covers every packet in the batch.
+                last_rx = time.monotonic()
+                for key, _ in events:
+                    sock = key.fileobj
+
+                    if forwarder is not None:
+                        if sock is c2d_socket:
+                            forwarder.pump(
+                                c2d_socket.fileno(), sumo_sock.fileno(),
+                                repeater_fds, C2D_PREFIX
+                            )
+                        else:
+                            forwarder.pump(
+                                d2c_socket.fileno(), client_sock.fileno(),
+                                repeater_fds, D2C_PREFIX
+                            )
+                        continue
+
+                    length, _ = sock.recvfrom_into(recv_buf)
+                    data = recv_view[:length]
+
+                    if sock is c2d_socket:
+                        sumo_sock.send(data)
+
+                        # Tee-off the data to another hosts
+                        for repeater in repeater_socks:
+                            repeater.sendmsg((C2D_PREFIX, data))
+                    else:
+                        client_sock.send(data)
+
+                        # Tee-off the data to another hosts
+                        for repeater in repeater_socks:
+                            repeater.sendmsg((D2C_PREFIX, data))
+        finally:
+            selector.close()
+            for sock in session_socks:
+                sock.close()
+
+    def start(self):
+        """ Handle all the things.
+        """
+        # Find the robot
+        print('Searching for Jumping Sumo...', end=' ')
+        sumo_ip, init_port = self.get_first_sumo()
+        print('Done (found {})!'.format(sumo_ip))
+
+        # Announce equivalent sumo
+        print('Announcing Sumo Proxy...', end=' ')
+        self.announce_proxy_sumo(init_port)
+        print('Done!')
+
+        print('Waiting for client initiation...', end=' ')
+        client_ip, ports = self.proxy_init(sumo_ip, init_port)
+        print('Done!')
+
+        # If sumo_c2d_port (ports[0]) is zero, Sumo is currently in a session.
+        if ports[0] == 0:
+            raise Exception(
+                'Sumo responded that another client is already connected!'
+            )
+
+        print('Serving session...', end=' ')
+        self.proxy_session(client_ip, sumo_ip, *ports)
+        print('Done!')
+
+
+def proc_wrapper(repeaters=None):
+    """ Run the proxy once, cleaning up whatever it leaves behind.
+    """
+    if repeaters is None:
+        repeaters = []
+    proxy = SumoProxy(repeaters)
+    try:
+        proxy.start()
+    except Exception as ex:
+        print('Ex: {}'.format(ex))
+    finally:
+        proxy.close()
+
+
+if __name__ == '__main__':
+
+    print('Starting...')
+    while True:
+        proc_wrapper()
+        print('Restarting...')
+        time.sleep(1)
@@ -1,31 +1,61 @@
-import threading
-import SocketServer
-
-
-def repr_bytes(bytes, maximum=25):
-    """ Nicer data printing.
-    """
-    return ''.join('\\x{:02x}'.format(ord(c)) for c in bytes[:maximum])
-
-
-if __name__ == '__main__':
-    # Patch to recieve video packets (+ direction indicator)
-    SocketServer.UDPServer.max_packet_size = 65000
-
-    # Create server
-    class Handler(SocketServer.BaseRequestHandler):
-
-        def handle(self):
-            data = self.request[0]
-
-            # From client to sumo
-            if data[0] == '>':
-                print '> {}'.format(repr_bytes(data[1:]))
-            # From sumo to client
-            elif data[0] == '<':
-                print '< {}'.format(repr_bytes(data[1:]))
-
-    server = SocketServer.UDPServer(('127.0.0.1', 65432), Handler)
-    t = threading.Thread(target=server.serve_forever)
-    t.start()
-    t.join()
+import collections
+import sys
+import threading
+import time
+import socketserver
+
+
+def repr_bytes(data, maximum=25):
+    """ Nicer data printing.
+
+        bytes.hex does the formatting in C rather than a Python-level
+        format call per byte.
+    """
+    data = data[:maximum]
+    if not data:
+        return ''
+    return '\\x' + data.hex('-').replace('-', '\\x')
+
+
+if __name__ == '__main__':
+    # Patch to recieve video packets (+ direction indicator)
+    socketserver.UDPServer.max_packet_size = 65000
+
+    # Buffer raw packets so the receive path does no formatting and
+    # never blocks on a slow terminal - the writer thread formats and
+    # drains them with one write + flush. Packets the terminal can't
+    # keep up with are dropped from the front, never formatted.
+    packets = collections.deque(maxlen=1000)
+
+    def drain(interval=0.1):
+        """ Periodically format and flush the buffered packets to stdout.
+        """
+        while True:
+            time.sleep(interval)
+            if packets:
+                batch = [packets.popleft() for _ in range(len(packets))]
+                sys.stdout.write(''.join(
+                    '{} {}\n'.format(chr(data[0]), repr_bytes(data[1:]))
+                    for data in batch
+                ))
+                sys.stdout.flush()
+
+    # Create server
+    class Handler(socketserver.BaseRequestHandler):
+
+        def handle(self):
+            data = self.request[0]
+
+            # Keep anything with a direction marker, client to sumo ('>')
+            # or sumo to client ('<').
+            if data[:1] in (b'>', b'<'):
+                packets.append(data)
+
+    writer = threading.Thread(target=drain)
+    writer.daemon = True
+    writer.start()
+
+    server = socketserver.UDPServer(('127.0.0.1', 65432), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    t.join()